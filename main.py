@@ -1,11 +1,20 @@
 import os
-import requests
+import time
+import asyncio
+import httpx
 import logging
+import numpy as np
+import orjson
+import simsimd
+from numba import njit
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from supabase import create_client, Client
+from supabase import acreate_client, AsyncClient, AsyncClientOptions
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from typing import List
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, Field, field_validator
+from typing import Any, List, Optional, Set, Tuple
 
 # ==============================================================================
 # 1. SETUP & INITIALIZATION
@@ -21,7 +30,10 @@ SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Supabase URL and Key must be set in the .env file.")
 
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Async Supabase client, created in `lifespan`. It is shared by all requests so
+# RPC calls reuse one pooled HTTP/2 connection instead of a new TLS handshake each.
+supabase: Optional[AsyncClient] = None
+SUPABASE_HTTP_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -32,20 +44,34 @@ HF_EMBEDDING_MODEL = os.getenv("HF_EMBEDDING_MODEL", "sentence-transformers/all-
 if not HF_API_TOKEN:
     logging.warning("HF_API_TOKEN not set. Set it to use Hugging Face Inference API for embeddings.")
 
-def generate_text_embedding(text: str) -> List[float]:
-    """Generate an embedding using Hugging Face Inference API to avoid heavy local models."""
-    if not HF_API_TOKEN:
-        raise ValueError("HF_API_TOKEN must be set to generate embeddings via Hugging Face Inference API.")
+# Use the models endpoint (recommended)
+HF_API_URL = f"https://api-inference.huggingface.co/models/{HF_EMBEDDING_MODEL}"
+
+# Shared keep-alive HTTP/2 client for the Inference API, managed by `lifespan`
+HF_CLIENT: Optional[httpx.AsyncClient] = None
+
+# Dynamic batching: concurrent /search calls are grouped into one Inference API request
+EMBEDDING_MAX_BATCH = 32
+EMBEDDING_MAX_WAIT_MS = 8
+EMBEDDING_QUEUE_SIZE = 256
+
+# Pending (text, future) pairs consumed by `embedding_batch_worker`, created in `lifespan`
+EMBEDDING_QUEUE: Optional["asyncio.Queue[Tuple[str, asyncio.Future]]"] = None
+
+# In-flight `embed_batch` tasks, cancelled by `lifespan` on shutdown
+EMBEDDING_BATCH_TASKS: Set[asyncio.Task] = set()
+
+async def request_embeddings(texts: List[str]) -> list:
+    """Send a batch of texts to the Hugging Face Inference API and return the raw JSON."""
+    if HF_CLIENT is None:
+        raise RuntimeError("Hugging Face HTTP client is not initialized")
 
-    # Use the models endpoint (recommended)
-    api_url = f"https://api-inference.huggingface.co/models/{HF_EMBEDDING_MODEL}"
-    headers = {"Authorization": f"Bearer {HF_API_TOKEN}", "Accept": "application/json"}
     try:
-        response = requests.post(api_url, json={"inputs": text, "truncate": True}, headers=headers, timeout=60)
+        response = await HF_CLIENT.post(HF_API_URL, json={"inputs": texts, "truncate": True})
         response.raise_for_status()
-        data = response.json()
-    except requests.HTTPError as http_err:
-        status = getattr(http_err.response, "status_code", None)
+        return response.json()
+    except httpx.HTTPStatusError as http_err:
+        status = http_err.response.status_code
         if status == 401:
             logging.error("HF Inference API unauthorized. Check HF_API_TOKEN permissions.")
         elif status == 404:
@@ -57,29 +83,256 @@ def generate_text_embedding(text: str) -> List[float]:
         logging.exception("Embedding API request failed")
         raise
 
-    # The API returns nested lists: [token_embeddings] or [sentence_embedding]
-    # For sentence-transformers models with pooling, it returns a single vector.
-    # If it's token-level, average pool across tokens.
-    if isinstance(data, list) and len(data) > 0 and isinstance(data[0], list):
-        # If first element is itself a list of floats, assume sentence vector
-        if all(isinstance(x, (int, float)) for x in data[0]):
-            # Heuristic: if shape is [dim] return as-is; if [tokens][dim], average
-            if all(isinstance(x, (int, float)) for x in data):
-                return [float(x) for x in data]
-            # Average across tokens
-            token_vectors = data
-            dim = len(token_vectors[0])
-            sums = [0.0] * dim
-            for vec in token_vectors:
-                for i, val in enumerate(vec):
-                    sums[i] += float(val)
-            return [s / max(1, len(token_vectors)) for s in sums]
-
-    # If response format unexpected, raise
-    raise RuntimeError("Unexpected embedding format from Hugging Face Inference API")
+@njit("float32[:](float32[:], int64, int64)", fastmath=True, cache=True)
+def mean_pool(flat: np.ndarray, n_tokens: int, dim: int) -> np.ndarray:
+    """Average a flattened [tokens][dim] buffer across tokens (compiled at import)."""
+    out = np.zeros(dim, dtype=np.float32)
+    for t in range(n_tokens):
+        for d in range(dim):
+            out[d] += flat[t * dim + d]
+    return out / np.float32(n_tokens)
+
+def pool_embedding(data: Any) -> np.ndarray:
+    """Turn the API output for a single input into one L2-normalized sentence vector."""
+    # One C-level conversion validates the payload: ragged rows raise, and
+    # strings, bools or None produce a non-numeric dtype that is rejected below.
+    try:
+        arr = np.asarray(data)
+    except (TypeError, ValueError) as exc:
+        raise RuntimeError("Unexpected embedding format from Hugging Face Inference API") from exc
+    if arr.dtype.kind not in "if" or arr.ndim not in (1, 2) or arr.size == 0:
+        # If response format unexpected, raise
+        raise RuntimeError("Unexpected embedding format from Hugging Face Inference API")
+
+    # For sentence-transformers models with pooling, the API returns a single vector [dim].
+    # If it's token-level [tokens][dim], average pool across tokens.
+    if arr.ndim == 2:
+        n_tokens, dim = arr.shape
+        vec = mean_pool(arr.astype(np.float32).ravel(), n_tokens, dim)
+    else:
+        vec = arr.astype(np.float32)
+
+    # Normalize once so every downstream similarity is a plain dot product
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm > 0 else vec
+
+async def embed_batch(batch: List[Tuple[str, asyncio.Future]]) -> None:
+    """Send one batch to the Inference API and resolve each caller's future with its raw output."""
+    try:
+        data = await request_embeddings([text for text, _ in batch])
+        if not isinstance(data, list) or len(data) != len(batch):
+            raise RuntimeError("Unexpected embedding format from Hugging Face Inference API")
+    except asyncio.CancelledError:
+        # Shutting down: don't leave callers waiting forever
+        for _, future in batch:
+            future.cancel()
+        raise
+    except Exception as exc:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(exc)
+        return
+
+    # Pooling happens in each caller, so one batch never blocks the loop for all of them
+    for (_, future), item in zip(batch, data):
+        if not future.done():
+            future.set_result(item)
+
+async def embedding_batch_worker() -> None:
+    """
+    Drain the embedding queue in batches of up to EMBEDDING_MAX_BATCH texts,
+    waiting at most EMBEDDING_MAX_WAIT_MS for a batch to fill. Each batch is
+    sent in its own task so several Inference API requests can be in flight.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await EMBEDDING_QUEUE.get()]
+        deadline = loop.time() + EMBEDDING_MAX_WAIT_MS / 1000
+        while len(batch) < EMBEDDING_MAX_BATCH:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(EMBEDDING_QUEUE.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        # Callers that gave up (e.g. client disconnected) don't need an embedding
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            continue
+
+        task = asyncio.create_task(embed_batch(batch))
+        EMBEDDING_BATCH_TASKS.add(task)
+        task.add_done_callback(EMBEDDING_BATCH_TASKS.discard)
+
+def to_halfvec_literal(embedding: np.ndarray) -> str:
+    """
+    Format an embedding as a pgvector text literal rounded to half precision,
+    matching the halfvec(384) parameter of `match_health_documents`.
+    orjson writes the numpy buffer directly, so no Python float is created
+    per element (its "[x,y,...]" output is already pgvector's literal format).
+    """
+    return orjson.dumps(embedding.astype(np.float16), option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+async def generate_text_embedding(text: str) -> np.ndarray:
+    """Generate an embedding using Hugging Face Inference API to avoid heavy local models."""
+    if not HF_API_TOKEN:
+        raise ValueError("HF_API_TOKEN must be set to generate embeddings via Hugging Face Inference API.")
+    if EMBEDDING_QUEUE is None:
+        raise RuntimeError("Embedding batch queue is not initialized")
+
+    # Hand the text to the batch worker; the bounded queue applies backpressure
+    future = asyncio.get_running_loop().create_future()
+    await EMBEDDING_QUEUE.put((text, future))
+    return pool_embedding(await future)
+
+# Semantic cache settings: near-duplicate queries reuse a previous search result
+EMBEDDING_DIM = 384
+SEMANTIC_CACHE_THRESHOLD = 0.85
+SEMANTIC_CACHE_TTL_SECONDS = 300
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+
+class SemanticCache:
+    """
+    In-process LRU + TTL cache of search results keyed by L2-normalized query
+    embeddings. A lookup hits when the cosine similarity to a cached query is
+    at least `threshold`, which lets us skip the Supabase RPC entirely.
+    Callers pass embeddings that are already normalized, so cosine similarity
+    is just the dot product.
+
+    Normalized embeddings lie in [-1, 1], so they are stored quantized to int8
+    with a fixed scale of 127 to cut the memory scanned per lookup by 4x.
+    """
+
+    def __init__(self, dim: int, max_entries: int, ttl_seconds: float, threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        # Preallocated rows written in place; row i belongs to entries[i]
+        self.matrix_i8 = np.zeros((max_entries, dim), dtype=np.int8)
+        self.entries: List[Optional[Tuple[str, List[str], float]]] = [None] * max_entries
+        # Number of rows ever written; only matrix_i8[:size] is scanned
+        self.size = 0
+        # Rows freed by TTL expiry, reused before evicting anything
+        self.free_rows: List[int] = []
+        # Occupied rows in least- to most-recently used order
+        self.lru: "OrderedDict[int, None]" = OrderedDict()
+
+    @staticmethod
+    def _quantize(embedding: np.ndarray) -> np.ndarray:
+        return np.round(embedding * 127).astype(np.int8)
+
+    def _remove(self, row: int) -> None:
+        # A zeroed row scores 0 and can never reach the threshold
+        self.lru.pop(row, None)
+        self.matrix_i8[row] = 0
+        self.entries[row] = None
+        self.free_rows.append(row)
+
+    def lookup(self, embedding: np.ndarray) -> Optional[Tuple[str, List[str], float]]:
+        """Return (context, sources, inserted_at) of the best fresh match above the threshold."""
+        if not self.lru:
+            return None
+        query = self._quantize(embedding)
+        # SIMD int8 dot products from the query to every cached row in one call
+        dots = np.asarray(simsimd.cdist(query.reshape(1, -1), self.matrix_i8[:self.size], metric="dot"))[0]
+        now = time.monotonic()
+        while True:
+            best = int(np.argmax(dots))
+            entry = self.entries[best]
+            if entry is None or dots[best] / (127 * 127) < self.threshold:
+                return None
+            context, sources, inserted_at = entry
+            if now - inserted_at <= self.ttl_seconds:
+                break
+            # Free the stale row and try the next best match, so it can't hide a fresh hit
+            self._remove(best)
+            dots[best] = -np.inf
+        self.lru.move_to_end(best)
+        return context, sources, inserted_at
+
+    def insert(self, embedding: np.ndarray, context: str, sources: List[str]) -> None:
+        if self.free_rows:
+            row = self.free_rows.pop()
+        elif self.size < self.max_entries:
+            row = self.size
+            self.size += 1
+        else:
+            # Overwrite the least recently used row in place
+            row, _ = self.lru.popitem(last=False)
+        self.matrix_i8[row] = self._quantize(embedding)
+        self.entries[row] = (context, sources, time.monotonic())
+        self.lru[row] = None
+
+semantic_cache = SemanticCache(
+    dim=EMBEDDING_DIM,
+    max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+    ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+)
+
+# Exact-match cache settings: repeated identical queries skip embedding entirely
+EXACT_CACHE_TTL_SECONDS = 300
+EXACT_CACHE_MAX_ENTRIES = 10000
+
+# Normalized query text -> (context, sources, inserted_at), in LRU order
+EXACT_CACHE: "OrderedDict[str, Tuple[str, List[str], float]]" = OrderedDict()
+
+def exact_cache_get(key: str) -> Optional[Tuple[str, List[str]]]:
+    """Return the cached search result for an identical recent query, if any."""
+    entry = EXACT_CACHE.get(key)
+    if entry is None:
+        return None
+    context, sources, inserted_at = entry
+    if time.monotonic() - inserted_at > EXACT_CACHE_TTL_SECONDS:
+        del EXACT_CACHE[key]
+        return None
+    EXACT_CACHE.move_to_end(key)
+    return context, sources
+
+def exact_cache_put(key: str, context: str, sources: List[str], inserted_at: float) -> None:
+    """
+    Store a search result, evicting the least recently used entries when full.
+    `inserted_at` is when the result was fetched, so a result copied from the
+    semantic cache doesn't get a fresh TTL.
+    """
+    EXACT_CACHE[key] = (context, sources, inserted_at)
+    EXACT_CACHE.move_to_end(key)
+    while len(EXACT_CACHE) > EXACT_CACHE_MAX_ENTRIES:
+        EXACT_CACHE.popitem(last=False)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open shared HTTP clients on startup and close them on shutdown."""
+    global HF_CLIENT, EMBEDDING_QUEUE, supabase
+    # Only the PostgREST client is used, so it can own this httpx client outright
+    supabase = await acreate_client(SUPABASE_URL, SUPABASE_KEY, options=AsyncClientOptions(
+        httpx_client=httpx.AsyncClient(http2=True, timeout=60, limits=SUPABASE_HTTP_LIMITS)
+    ))
+    headers = {"Accept": "application/json"}
+    if HF_API_TOKEN:
+        headers["Authorization"] = f"Bearer {HF_API_TOKEN}"
+    HF_CLIENT = httpx.AsyncClient(http2=True, timeout=60, headers=headers)
+    EMBEDDING_QUEUE = asyncio.Queue(maxsize=EMBEDDING_QUEUE_SIZE)
+    worker = asyncio.create_task(embedding_batch_worker())
+    try:
+        yield
+    finally:
+        worker.cancel()
+        for task in EMBEDDING_BATCH_TASKS:
+            task.cancel()
+        await asyncio.gather(worker, *EMBEDDING_BATCH_TASKS, return_exceptions=True)
+        EMBEDDING_QUEUE = None
+        await HF_CLIENT.aclose()
+        HF_CLIENT = None
+        await supabase.postgrest.aclose()
+        supabase = None
 
 # Initialize the FastAPI app
 app = FastAPI(
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
     title="SIH Health Chatbot API",
     description="An API to find relevant health information from a vector database.",
     version="1.0.0"
@@ -90,9 +343,18 @@ app = FastAPI(
 # 2. Pydantic Models (for Request and Response Data Validation)
 # ==============================================================================
 
+# Longer queries are rejected with a 422 before they reach the embedding API
+MAX_QUERY_LENGTH = 512
+
 # This defines the structure of the JSON we expect in the POST request body
 class SearchQuery(BaseModel):
-    query: str
+    query: str = Field(..., min_length=1, max_length=MAX_QUERY_LENGTH)
+
+    @field_validator("query", mode="before")
+    @classmethod
+    def collapse_whitespace(cls, value):
+        # Runs before the length checks, so whitespace-only queries are rejected too
+        return " ".join(value.split()) if isinstance(value, str) else value
 
 # This defines the structure of the JSON response we will send back
 class SearchResponse(BaseModel):
@@ -112,20 +374,34 @@ async def search_knowledge_base(search_query: SearchQuery):
     """
     query = search_query.query
 
-    # --- Step 1: Generate an embedding for the user's query (via HF Inference API) ---
+    # --- Step 1: Return the cached result of an identical recent query ---
+    cache_key = query.lower()
+    cached = exact_cache_get(cache_key)
+    if cached is not None:
+        context, sources = cached
+        return {"context": context, "sources": sources}
+
+    # --- Step 2: Generate an embedding for the user's query (via HF Inference API) ---
     try:
-        query_embedding = generate_text_embedding(query)
+        query_embedding = await generate_text_embedding(query)
     except ValueError as ve:
         # Likely missing HF_API_TOKEN
         raise HTTPException(status_code=503, detail=f"Embedding unavailable: {str(ve)}")
     except Exception as exc:
         raise HTTPException(status_code=502, detail="Failed to generate embedding from provider")
 
-    # --- Step 2: Call the Supabase database function ---
-    # We are calling the 'match_health_documents' function we created in the Supabase SQL Editor.
+    # --- Step 3: Reuse the result of a semantically similar recent query ---
+    cached = semantic_cache.lookup(query_embedding)
+    if cached is not None:
+        context, sources, inserted_at = cached
+        exact_cache_put(cache_key, context, sources, inserted_at)
+        return {"context": context, "sources": sources}
+
+    # --- Step 4: Call the Supabase database function ---
+    # We are calling the 'match_health_documents' function from sql/match_health_documents.sql.
     try:
-        response = supabase.rpc('match_health_documents', {
-            'query_embedding': query_embedding,
+        response = await supabase.rpc('match_health_documents', {
+            'query_embedding': to_halfvec_literal(query_embedding),
             'match_threshold': 0.70,
             'match_count': 3
         }).execute()
@@ -133,19 +409,21 @@ async def search_knowledge_base(search_query: SearchQuery):
         logging.exception("Supabase RPC call failed")
         raise HTTPException(status_code=502, detail="Vector search failed")
 
-    # --- Step 3: Process the results and create the context ---
+    # --- Step 5: Process the results and create the context ---
     context = ""
     sources = []
     
     if getattr(response, 'data', None):
         # Combine the content of the matched documents into a single string
-        context = "\n\n---\n\n".join([item['content'] for item in response.data])
+        context = "\n\n---\n\n".join(item['content'] for item in response.data)
         
         # Collect the unique sources from the metadata
-        sources = list(set([item['metadata']['source'] for item in response.data]))
+        sources = list({item['metadata']['source'] for item in response.data})
     else:
         logging.info("No matches returned from Supabase for query")
 
+    semantic_cache.insert(query_embedding, context, sources)
+    exact_cache_put(cache_key, context, sources, time.monotonic())
     return {"context": context, "sources": sources}
 
 
@@ -1,8 +1,14 @@
 import os
 import re
+import asyncio
+import httpx
+import numpy as np
+from pathlib import Path
 from dotenv import load_dotenv
-from supabase import create_client, Client
-from sentence_transformers import SentenceTransformer
+from supabase._async.client import AsyncClient, create_client as create_async_client
+from onnxruntime.quantization import quantize_dynamic, QuantType
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
 from typing import List, Dict, Any
 
 # ==============================================================================
@@ -20,14 +26,44 @@ SUPABASE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
 if not SUPABASE_URL or not SUPABASE_KEY:
     raise ValueError("Supabase URL and Key must be set in the .env file.")
 
-# Initialize the Supabase client
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Supabase upload settings
+UPLOAD_BATCH_SIZE = 100 # Upload in batches of 100 to avoid timeouts
+UPLOAD_CONCURRENCY = 8 # Number of batches in flight at once
+UPLOAD_MAX_RETRIES = 5
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
 
-# Initialize the Sentence Transformer model for creating embeddings
+# Blank lines (double newline characters) usually separate paragraphs
+PARAGRAPH_SPLIT_RE = re.compile(r'\n\s*\n')
+
+# Initialize the embedding model, run through ONNX Runtime with INT8 weights
 # 'all-MiniLM-L6-v2' is a great general-purpose model that creates 384-dimensional vectors.
-MODEL_NAME = 'all-MiniLM-L6-v2'
-print("Loading sentence-transformer model...")
-model = SentenceTransformer(MODEL_NAME)
+MODEL_NAME = 'sentence-transformers/all-MiniLM-L6-v2'
+ONNX_MODEL_DIR = 'onnx_model'
+QUANTIZED_MODEL_FILE = 'model_quantized.onnx'
+EMBED_BATCH_SIZE = 64
+MAX_SEQ_LENGTH = 256 # Same truncation length sentence-transformers uses for this model
+
+def load_onnx_model(model_name: str, model_dir: str):
+    """
+    Exports the model to ONNX and quantizes it to INT8 on first use,
+    then loads the quantized model and its tokenizer from `model_dir`.
+    """
+    quantized_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+    if not os.path.exists(quantized_path):
+        print(f"Exporting '{model_name}' to ONNX and quantizing to INT8...")
+        ORTModelForFeatureExtraction.from_pretrained(model_name, export=True).save_pretrained(model_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(model_dir)
+        quantize_dynamic(
+            model_input=os.path.join(model_dir, 'model.onnx'),
+            model_output=quantized_path,
+            weight_type=QuantType.QInt8
+        )
+    onnx_model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=QUANTIZED_MODEL_FILE)
+    onnx_tokenizer = AutoTokenizer.from_pretrained(model_dir)
+    return onnx_model, onnx_tokenizer
+
+print("Loading ONNX embedding model...")
+model, tokenizer = load_onnx_model(MODEL_NAME, ONNX_MODEL_DIR)
 print("Model loaded successfully.")
 
 
@@ -41,19 +77,19 @@ def load_documents_from_folder(folder_path: str) -> List[Dict[str, Any]]:
     """
     documents = []
     print(f"Loading documents from '{folder_path}'...")
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".txt"):
-            file_path = os.path.join(folder_path, filename)
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-                # Each document is a dictionary with its content and metadata
-                doc = {
-                    "content": content,
-                    "metadata": {
-                        "source": filename
-                    }
-                }
-                documents.append(doc)
+    # scandir yields entries with cached file type info, so no extra stat per file
+    with os.scandir(folder_path) as entries:
+        text_files = [entry for entry in entries if entry.name.endswith(".txt") and entry.is_file()]
+    for entry in text_files:
+        content = Path(entry.path).read_text(encoding='utf-8')
+        # Each document is a dictionary with its content and metadata
+        doc = {
+            "content": content,
+            "metadata": {
+                "source": entry.name
+            }
+        }
+        documents.append(doc)
     print(f"Found and loaded {len(documents)} documents.")
     return documents
 
@@ -63,7 +99,7 @@ def chunk_document(document: Dict[str, Any]) -> List[Dict[str, Any]]:
     This is crucial for effective semantic search.
     """
     # Splitting by double newline characters, which usually separate paragraphs.
-    content_chunks = re.split(r'\n\s*\n', document["content"])
+    content_chunks = PARAGRAPH_SPLIT_RE.split(document["content"])
     
     chunked_documents = []
     for chunk in content_chunks:
@@ -76,6 +112,83 @@ def chunk_document(document: Dict[str, Any]) -> List[Dict[str, Any]]:
     return chunked_documents
 
 
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """
+    Embeds texts in batches with the ONNX model, using mean pooling over
+    the attention mask and L2 normalization like sentence-transformers does.
+    """
+    batch_embeddings = []
+    for i in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[i:i + EMBED_BATCH_SIZE]
+        print(f"Embedding batch {i // EMBED_BATCH_SIZE + 1}...")
+        inputs = tokenizer(batch, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors='np')
+        token_embeddings = np.asarray(model(**inputs).last_hidden_state, dtype=np.float32)
+
+        # Mean pooling that ignores padding tokens
+        mask = inputs['attention_mask'][..., np.newaxis].astype(np.float32)
+        pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        batch_embeddings.append(pooled / np.clip(norms, 1e-12, None))
+
+    if not batch_embeddings:
+        return np.empty((0, model.config.hidden_size), dtype=np.float32)
+    return np.concatenate(batch_embeddings)
+
+
+async def raise_for_retryable_status(response: httpx.Response):
+    """
+    httpx response hook that raises HTTPStatusError for rate-limit / server errors.
+    postgrest's APIError carries the PostgREST error code from the JSON body rather
+    than the HTTP status, so the status has to be checked before it parses the body.
+    """
+    if response.status_code in RETRYABLE_STATUS_CODES:
+        response.raise_for_status()
+
+def is_retryable_error(exc: Exception) -> bool:
+    """
+    Returns True for network failures and rate-limit / server errors that are
+    worth retrying; other API errors (e.g. bad payloads) will fail again.
+    """
+    if isinstance(exc, httpx.TransportError):
+        return True
+    return isinstance(exc, httpx.HTTPStatusError) and exc.response.status_code in RETRYABLE_STATUS_CODES
+
+async def upload_batch(client: AsyncClient, semaphore: asyncio.Semaphore, batch: List[Dict[str, Any]], batch_number: int):
+    """
+    Inserts one batch into Supabase, retrying transient failures with exponential backoff.
+    """
+    async with semaphore:
+        for attempt in range(UPLOAD_MAX_RETRIES + 1):
+            print(f"Uploading batch {batch_number}...")
+            try:
+                await client.table('health_knowledge_base').insert(batch).execute()
+                return
+            except Exception as e:
+                if attempt == UPLOAD_MAX_RETRIES or not is_retryable_error(e):
+                    print(f"Error inserting batch {batch_number}: {e}")
+                    return
+                delay = 2 ** attempt
+                print(f"Batch {batch_number} failed ({e}), retrying in {delay}s...")
+                await asyncio.sleep(delay)
+
+async def upload_records(data_to_insert: List[Dict[str, Any]]):
+    """
+    Uploads all records in fixed-size batches, with up to UPLOAD_CONCURRENCY
+    batches in flight so network round trips overlap.
+    """
+    client = await create_async_client(SUPABASE_URL, SUPABASE_KEY)
+    client.postgrest.session.event_hooks['response'].append(raise_for_retryable_status)
+    semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    try:
+        await asyncio.gather(*[
+            upload_batch(client, semaphore, data_to_insert[i:i + UPLOAD_BATCH_SIZE], i // UPLOAD_BATCH_SIZE + 1)
+            for i in range(0, len(data_to_insert), UPLOAD_BATCH_SIZE)
+        ])
+    finally:
+        await client.postgrest.aclose()
+
+
 # ==============================================================================
 # 3. MAIN EXECUTION LOGIC
 # ==============================================================================
@@ -104,30 +217,25 @@ def main():
     # Extract just the content for efficient batch embedding
     contents_to_embed = [chunk["content"] for chunk in all_chunks]
     
-    # Generate embeddings in a single batch (highly efficient)
-    embeddings = model.encode(contents_to_embed, show_progress_bar=True)
+    # Generate embeddings in fixed-size batches
+    embeddings = embed_texts(contents_to_embed)
     
+    # Convert the whole numpy array to lists for Supabase in a single call
+    embedding_lists = embeddings.tolist()
+
     # Prepare the final data payload for Supabase
     data_to_insert = []
     for i, chunk in enumerate(all_chunks):
         data_to_insert.append({
             'content': chunk['content'],
             'metadata': chunk['metadata'],
-            'embedding': embeddings[i].tolist() # Convert numpy array to list for Supabase
+            'embedding': embedding_lists[i]
         })
         
     print(f"Embeddings generated. Preparing to upload {len(data_to_insert)} records.")
     
-    # --- Step 4: Insert the data into Supabase in batches ---
-    batch_size = 100 # Upload in batches of 100 to avoid timeouts
-    for i in range(0, len(data_to_insert), batch_size):
-        batch = data_to_insert[i:i + batch_size]
-        print(f"Uploading batch {i // batch_size + 1}...")
-        try:
-            response = supabase.table('health_knowledge_base').insert(batch).execute()
-        except Exception as e:
-            print(f"Error inserting batch {i // batch_size + 1}: {e}")
-            # You might want to add error handling or retries here
+    # --- Step 4: Insert the data into Supabase in concurrent batches ---
+    asyncio.run(upload_records(data_to_insert))
     
     print("\n========================================================")
     print("      Data population complete! Your AI is ready.     ")
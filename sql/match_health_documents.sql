@@ -0,0 +1,37 @@
+-- Vector search function called by POST /search (see main.py).
+-- Run this in the Supabase SQL Editor. Requires pgvector 0.7+ for halfvec.
+--
+-- The query embedding arrives as a half-precision (fp16) pgvector literal and is
+-- compared against a halfvec expression index, which takes half the memory of a
+-- vector(384) index so more of the HNSW graph stays in RAM.
+
+create index if not exists health_knowledge_base_embedding_halfvec_idx
+  on health_knowledge_base
+  using hnsw ((embedding::halfvec(384)) halfvec_cosine_ops);
+
+-- Replace the previous vector(384) signature
+drop function if exists match_health_documents(vector, float, int);
+
+create or replace function match_health_documents (
+  query_embedding halfvec(384),
+  match_threshold float,
+  match_count int
+)
+returns table (
+  id bigint,
+  content text,
+  metadata jsonb,
+  similarity float
+)
+language sql stable
+as $$
+  select
+    health_knowledge_base.id,
+    health_knowledge_base.content,
+    health_knowledge_base.metadata,
+    1 - (health_knowledge_base.embedding::halfvec(384) <=> query_embedding) as similarity
+  from health_knowledge_base
+  where health_knowledge_base.embedding::halfvec(384) <=> query_embedding < 1 - match_threshold
+  order by health_knowledge_base.embedding::halfvec(384) <=> query_embedding
+  limit match_count;
+$$;